@@ -10,9 +10,14 @@ Usa Claude Vision (via OpenRouter) para extraer información.
 
 import streamlit as st
 import base64
+import hashlib
+import io
 import os
 import json
+import re
+from collections import ChainMap
 from openai import OpenAI
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
 
 # Cargar variables de entorno (local)
@@ -26,81 +31,65 @@ def get_api_key():
     # Luego variables de entorno
     return os.getenv("OPENROUTER_API_KEY")
 
-# Cliente se inicializa de forma perezosa
-_client = None
-
+# Cliente único compartido entre reruns y sesiones (reutiliza el pool de conexiones)
+@st.cache_resource(show_spinner=False)
 def get_client():
-    global _client
-    if _client is None:
-        api_key = get_api_key()
-        if not api_key:
-            st.error("⚠️ No se encontró OPENROUTER_API_KEY. Configura los Secrets en Streamlit Cloud.")
-            st.stop()
-        _client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key
-        )
-    return _client
+    api_key = get_api_key()
+    if not api_key:
+        st.error("⚠️ No se encontró OPENROUTER_API_KEY. Configura los Secrets en Streamlit Cloud.")
+        st.stop()
+    return OpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=api_key
+    )
 
 # Modelo de Claude con visión
 VISION_MODEL = "anthropic/claude-sonnet-4"
 
-# Plantilla base para el prompt de Lovable (actualizada)
-PLANTILLA_LOVABLE = """Crea una landing page de registro para webinar usando las imágenes adjuntas como referencia:
-- Imagen del brandboard → para colores, tipografía y estilo visual
-- Imágenes de estructura (opcional) → para ver layouts de secciones
-
-DATOS TÉCNICOS:
-- Color primario: {color_primario}
-- Color secundario: {color_secundario}
-- Color de texto: {color_texto}
-- Color de fondo: {color_fondo}
-- Tipografía: {tipografia}
-- Estilo: {estilo}
-- Botones: fondo {color_secundario}, texto blanco, bordes redondeados
-
-IMPORTANTE: NO modifiques el texto que te proporciono. Cópialo exactamente palabra por palabra, sin cambiar ni una coma.
-
-SECCIONES:
-
-{secciones}
-
-NOTAS TÉCNICAS:
-- Mobile-first, responsive
-- Donde indique FOTO, IMAGEN o MOCKUP, dejar placeholder gris
-- Formulario con validación básica
-- Contadores regresivos funcionales si aplica
-- Scroll suave entre secciones
-
-RECORDATORIO: No modifiques el texto. Cada palabra, cada coma, cada punto debe ser exacto."""
-
-
-def encode_image_to_base64(uploaded_file):
-    """Convierte un archivo subido a base64."""
-    return base64.standard_b64encode(uploaded_file.read()).decode("utf-8")
-
-
-def get_image_media_type(filename):
-    """Determina el tipo MIME de la imagen."""
-    ext = filename.lower().split('.')[-1]
-    types = {
-        'png': 'image/png',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'gif': 'image/gif',
-        'webp': 'image/webp'
-    }
-    return types.get(ext, 'image/png')
-
-
-def extract_brand_info(brandboard_images):
-    """Extrae información de marca del brandboard usando Claude Vision."""
+# Modelo más rápido y barato para el paso de solo texto (estructurar el copy)
+STRUCTURING_MODEL = "anthropic/claude-haiku-4.5"
+STRUCTURING_MAX_TOKENS = 8000
+
+# Lado máximo de las imágenes enviadas (umbral a partir del cual Claude reescala)
+IMAGE_MAX_SIDE = 1568
+
+# Tope de salida de extract_all: marca + copy crudo + el mismo copy en
+# secciones, todo como strings JSON escapados (Sonnet 4 admite hasta 64k)
+EXTRACT_ALL_MAX_TOKENS = 16000
+
+# Número máximo de resultados de extract_all guardados en memoria
+EXTRACTION_STORE_SIZE = 32
+
+# Prompt caching de Anthropic (OpenRouter reenvía `cache_control` al proveedor)
+CACHE_CONTROL = {"type": "ephemeral"}
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+# Esquema JSON de la información de marca (structured outputs)
+BRAND_SCHEMA = {
+    "type": "object",
+    "required": [
+        "color_primario",
+        "color_secundario",
+        "color_texto",
+        "color_fondo",
+        "tipografia",
+        "estilo",
+        "notas_adicionales"
+    ],
+    "properties": {
+        "color_primario": {"type": "string"},
+        "color_secundario": {"type": "string"},
+        "color_texto": {"type": "string"},
+        "color_fondo": {"type": "string"},
+        "tipografia": {"type": "string"},
+        "estilo": {"type": "string"},
+        "notas_adicionales": {"type": "string"}
+    },
+    "additionalProperties": False
+}
 
-    # Construir mensaje con imágenes
-    content = [
-        {
-            "type": "text",
-            "text": """Analiza este brandboard/manual de marca y extrae la siguiente información en formato JSON:
+# Instrucciones para extraer la información de marca del brandboard
+PROMPT_BRANDBOARD = """Analiza este brandboard/manual de marca y extrae la siguiente información en formato JSON:
 
 {
     "color_primario": "#HEXCODE (el color principal de la marca)",
@@ -117,105 +106,19 @@ IMPORTANTE sobre tipografía:
 - Debe ser una fuente que exista en Google Fonts
 - Ejemplos válidos: "Be Vietnam Pro", "Montserrat", "Poppins", "Inter", "Playfair Display"
 
-Si no puedes identificar algo con certeza, indica "NO IDENTIFICADO".
-Responde SOLO con el JSON, sin explicaciones adicionales."""
-        }
-    ]
-
-    # Añadir imágenes
-    for img in brandboard_images:
-        img.seek(0)  # Reset file pointer
-        base64_img = encode_image_to_base64(img)
-        media_type = get_image_media_type(img.name)
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:{media_type};base64,{base64_img}"
-            }
-        })
-
-    response = get_client().chat.completions.create(
-        model=VISION_MODEL,
-        messages=[{"role": "user", "content": content}],
-        max_tokens=1000
-    )
-
-    # Parsear respuesta JSON
-    response_text = response.choices[0].message.content.strip()
-    # Limpiar si viene con ```json
-    if response_text.startswith("```"):
-        response_text = response_text.split("```")[1]
-        if response_text.startswith("json"):
-            response_text = response_text[4:]
-    response_text = response_text.strip()
-
-    try:
-        return json.loads(response_text)
-    except json.JSONDecodeError:
-        return {
-            "color_primario": "NO IDENTIFICADO",
-            "color_secundario": "NO IDENTIFICADO",
-            "tipografia": "NO IDENTIFICADO",
-            "estilo_botones": "NO IDENTIFICADO",
-            "notas_adicionales": response_text
-        }
-
-
-def extract_copy(copy_images):
-    """Extrae el copy textual de las capturas usando Claude Vision."""
-
-    content = [
-        {
-            "type": "text",
-            "text": """Transcribe TODO el texto visible en estas imágenes.
-
-REGLAS CRÍTICAS:
-1. Transcribe PALABRA POR PALABRA, exactamente como aparece
-2. NO resumas, NO parafrasees, NO "mejores" el texto
-3. Mantén saltos de línea donde los veas
-4. Si hay secciones claras, sepáralas con una línea en blanco
-5. Incluye TODO: títulos, subtítulos, bullets, botones, disclaimers
+Si no puedes identificar algo con certeza, indica "NO IDENTIFICADO"."""
 
-El copy de marketing está aprobado por el cliente y NO puede modificarse "ni una coma".
-
-Responde SOLO con el texto transcrito, sin comentarios tuyos."""
-        }
-    ]
-
-    # Añadir imágenes
-    for img in copy_images:
-        img.seek(0)
-        base64_img = encode_image_to_base64(img)
-        media_type = get_image_media_type(img.name)
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:{media_type};base64,{base64_img}"
-            }
-        })
-
-    response = get_client().chat.completions.create(
-        model=VISION_MODEL,
-        messages=[{"role": "user", "content": content}],
-        max_tokens=4000
-    )
+# Instrucciones para transcribir el copy de las capturas
+PROMPT_COPY = """Transcribe TODO el texto visible en estas imágenes.
 
-    return response.choices[0].message.content.strip()
+<rules>
+- Transcribe PALABRA POR PALABRA (copy aprobado: no cambies "ni una coma")
+- Incluye TODO: títulos, subtítulos, bullets, botones, disclaimers
+- Mantén los saltos de línea y separa las secciones con una línea en blanco
+</rules>"""
 
-
-def structure_copy_into_sections(raw_copy):
-    """Organiza el copy extraído en secciones numeradas para Lovable."""
-
-    response = get_client().chat.completions.create(
-        model=VISION_MODEL,
-        messages=[{
-            "role": "user",
-            "content": f"""Organiza el siguiente copy de landing page en secciones numeradas para Lovable.
-
-COPY EXTRAÍDO:
-{raw_copy}
-
-FORMATO DE SALIDA - Usa EXACTAMENTE este formato con secciones numeradas:
+# Formato de salida y reglas para organizar el copy en secciones
+PROMPT_SECCIONES = """FORMATO DE SALIDA - Usa EXACTAMENTE este formato con secciones numeradas:
 
 ### SECCIÓN 1: HERO (centrado)
 [Título principal]
@@ -265,31 +168,381 @@ Bio: [texto completo de la bio]
 [Fecha recordatorio]
 [Botón: texto del botón]
 
-REGLAS CRÍTICAS:
-1. Copia el texto EXACTAMENTE como está - PALABRA POR PALABRA
-2. NO resumas, NO parafrasees, NO "mejores" el texto
-3. Si una sección no existe en el copy, OMÍTELA (no la incluyas)
-4. Indica fotos con [PLACEHOLDER: descripción]
-5. NO inventes contenido que no esté en el copy original
-6. Para secciones de 2 columnas, especifica claramente qué va en cada columna"""
+<rules>
+- Copia el texto PALABRA POR PALABRA: no resumas, no parafrasees, no inventes
+- Si una sección no existe en el copy, omítela
+- Indica fotos con [PLACEHOLDER: descripción]
+</rules>"""
+
+# Instrucciones para extraer marca y secciones en una sola llamada
+PROMPT_EXTRACT_ALL = """Recibirás dos grupos de imágenes: las que siguen a "=== BRANDBOARD ===" (manual de marca) y las que siguen a "=== COPY ===" (copy aprobado de la landing).
+
+Responde con un JSON con tres campos:
+- "brand_info": la información de marca del brandboard.
+- "raw_copy": el texto transcrito de las imágenes del copy.
+- "sections_markdown": ese mismo copy, PALABRA POR PALABRA, organizado en secciones.
+
+== brand_info ==
+""" + PROMPT_BRANDBOARD + """
+
+== raw_copy ==
+""" + PROMPT_COPY + """
+
+== sections_markdown ==
+""" + PROMPT_SECCIONES
+
+# Esquema JSON de la extracción completa (marca + secciones)
+EXTRACT_ALL_SCHEMA = {
+    "type": "object",
+    "required": ["brand_info", "raw_copy", "sections_markdown"],
+    "properties": {
+        "brand_info": BRAND_SCHEMA,
+        "raw_copy": {"type": "string"},
+        "sections_markdown": {"type": "string"}
+    },
+    "additionalProperties": False
+}
+
+# Valores por defecto si falta algún dato de marca
+BRAND_DEFAULTS = {
+    "color_primario": "#000000",
+    "color_secundario": "#666666",
+    "color_texto": "gris oscuro",
+    "color_fondo": "blanco",
+    "tipografia": "Inter",
+    "estilo": "moderno, limpio, profesional"
+}
+
+# Plantilla base para el prompt de Lovable (actualizada)
+PLANTILLA_LOVABLE = """Crea una landing page de registro para webinar usando las imágenes adjuntas como referencia:
+- Imagen del brandboard → para colores, tipografía y estilo visual
+- Imágenes de estructura (opcional) → para ver layouts de secciones
+
+DATOS TÉCNICOS:
+- Color primario: {color_primario}
+- Color secundario: {color_secundario}
+- Color de texto: {color_texto}
+- Color de fondo: {color_fondo}
+- Tipografía: {tipografia}
+- Estilo: {estilo}
+- Botones: fondo {color_secundario}, texto blanco, bordes redondeados
+
+IMPORTANTE: NO modifiques el texto que te proporciono. Cópialo exactamente palabra por palabra, sin cambiar ni una coma.
+
+SECCIONES:
+
+{secciones}
+
+NOTAS TÉCNICAS:
+- Mobile-first, responsive
+- Donde indique FOTO, IMAGEN o MOCKUP, dejar placeholder gris
+- Formulario con validación básica
+- Contadores regresivos funcionales si aplica
+- Scroll suave entre secciones"""
+
+
+@st.cache_data(show_spinner=False)
+def encode_image_to_base64(data):
+    """Reduce la imagen a IMAGE_MAX_SIDE px, la recodifica a WebP y la pasa a base64.
+
+    Las capturas de móvil pesan varios MB; a partir de IMAGE_MAX_SIDE Claude
+    las reescala igualmente, así que enviarlas más grandes solo cuesta ancho
+    de banda y tokens de imagen.
+    """
+    # Aplica la orientación EXIF: al recodificar se pierde y las fotos de móvil
+    # llegarían giradas
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    mode = "RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB"
+    buf = io.BytesIO()
+    img.convert(mode).save(buf, "WEBP", quality=85, method=4)
+    return base64.standard_b64encode(buf.getvalue()).decode("ascii")
+
+
+def file_digests(files, images, key):
+    """SHA-1 de cada archivo subido en el uploader `key`.
+
+    Se guardan en session_state por file_id para no recalcularlos en cada
+    rerun; el dict se reconstruye con los archivos actuales para no acumular
+    los que el usuario ya quitó.
+    """
+    previous = st.session_state.get(key, {})
+    digests = {}
+    for f, (_, data) in zip(files, images):
+        digests[f.file_id] = previous.get(f.file_id) or hashlib.sha1(data).hexdigest()
+    st.session_state[key] = digests
+    return [digests[f.file_id] for f in files]
+
+
+def _image_blocks(images):
+    """Construye los bloques `image_url` para una lista de tuplas (nombre, bytes)."""
+    blocks = []
+    for _, data in images:
+        base64_img = encode_image_to_base64(data)
+        blocks.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/webp;base64,{base64_img}"
+            }
+        })
+    return blocks
+
+
+@st.cache_resource(show_spinner=False)
+def _extraction_store():
+    """Resultados de extract_all por hash de las imágenes, compartidos entre sesiones."""
+    return {}
+
+
+def _stream_completion(**kwargs):
+    """Llama a chat.completions.create en modo streaming.
+
+    Muestra el progreso (caracteres recibidos) en un placeholder mientras
+    llega la respuesta y lo limpia al terminar. Devuelve
+    (texto, uso de tokens, finish_reason).
+
+    No usar dentro de funciones con st.cache_data: Streamlit grabaría y
+    reproduciría cada actualización del placeholder.
+    """
+    response = get_client().chat.completions.create(
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs
+    )
+
+    buf = []
+    received = 0
+    usage = {}
+    finish_reason = None
+    ph = st.empty()
+    for chunk in response:
+        if chunk.usage is not None:
+            usage = _usage(chunk)
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta.content or ""
+        buf.append(delta)
+        received += len(delta)
+        ph.caption(f"⏳ Recibiendo respuesta... {received} caracteres")
+    ph.empty()
+
+    return "".join(buf).strip(), usage, finish_reason
+
+
+def _usage(response):
+    """Resume el uso de tokens de una respuesta, incluidos los leídos de caché."""
+    usage = response.usage
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(usage, "cache_read_input_tokens", None)
+    if cached is None and details is not None:
+        cached = getattr(details, "cached_tokens", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cache_read_input_tokens": cached or 0
+    }
+
+
+# Inicio de un bloque ```json (o ``` a secas) que contiene un objeto
+_JSON_FENCE = re.compile(r"```(?:json)?\s*(?=\{)")
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_json(text):
+    """Parsea el JSON de la respuesta.
+
+    Con structured outputs la respuesta ya es JSON puro, pero algunos
+    proveedores ignoran `response_format` y lo envuelven en ```json ... ```
+    o añaden texto alrededor. En ese caso se decodifica el primer objeto (el
+    del primer bloque ``` si lo hay) e ignora lo que venga detrás.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    fence = _JSON_FENCE.search(text)
+    if fence is not None:
+        start = fence.end()
+    else:
+        start = text.find("{")
+        if start == -1:
+            raise json.JSONDecodeError("No se encontró ningún objeto JSON", text, 0)
+    obj, _ = _JSON_DECODER.raw_decode(text, start)
+    return obj
+
+
+def _is_complete_extraction(extracted):
+    """Comprueba que el resultado de extract_all tiene todos los campos del esquema."""
+    return (
+        isinstance(extracted, dict)
+        and all(k in extracted for k in EXTRACT_ALL_SCHEMA["required"])
+        and isinstance(extracted["brand_info"], dict)
+        and isinstance(extracted["raw_copy"], str)
+        and isinstance(extracted["sections_markdown"], str)
+    )
+
+
+def _json_field(text, key):
+    """Decodifica el valor de `key` en un JSON posiblemente cortado.
+
+    Devuelve None si la clave no aparece o su valor no llegó completo.
+    """
+    m = re.search(rf'"{key}"\s*:\s*', text)
+    if m is None:
+        return None
+    try:
+        value, _ = _JSON_DECODER.raw_decode(text, m.end())
+    except json.JSONDecodeError:
+        return None
+    return value
+
+
+def _digest(images):
+    """Hash estable del contenido de las imágenes (clave de caché)."""
+    return hashlib.sha256(b"".join(data for _, data in images)).hexdigest()
+
+
+def _payloads(files):
+    """Lee una sola vez los UploadedFile en tuplas (nombre, bytes).
+
+    Los UploadedFile tienen estado (posición de lectura), no son thread-safe
+    ni hasheables; a partir de aquí todo el pipeline trabaja con bytes.
+    """
+    return [(f.name, f.getvalue()) for f in files]
+
+
+def dedupe_images(images, digests):
+    """Omite las imágenes repetidas (mismo contenido) para no enviarlas dos veces.
+
+    Devuelve (imágenes, digests) sin duplicados.
+    """
+    seen = set()
+    unique = []
+    for image, digest in zip(images, digests):
+        if digest not in seen:
+            seen.add(digest)
+            unique.append((image, digest))
+    if len(unique) < len(images):
+        st.caption(f"⚠️ {len(images) - len(unique)} duplicados omitidos")
+    return [image for image, _ in unique], [digest for _, digest in unique]
+
+
+def extract_all(brandboard_images, copy_images):
+    """Extrae marca y secciones del copy en una sola llamada a Claude Vision.
+
+    Analizar el brandboard, transcribir el copy y estructurarlo en secciones
+    se hace en una única petición. Devuelve
+    ({"brand_info", "raw_copy", "sections_markdown"}, uso de tokens).
+
+    El resultado se guarda por hash de las imágenes; la llamada en streaming
+    queda fuera de st.cache_data, que grabaría y reproduciría cada
+    actualización del progreso.
+    """
+    digest = f"{_digest(brandboard_images)}:{_digest(copy_images)}"
+    store = _extraction_store()
+    if digest in store:
+        # Sin llamada a la API: no hay uso de tokens que mostrar
+        return store[digest], {"from_cache": True}
+
+    # Prefijo cacheable: instrucciones + imágenes del brandboard. Solo las
+    # instrucciones quedan por debajo del mínimo de 1024 tokens de Anthropic;
+    # con el brandboard lo superan y se reutiliza al generar varias landings
+    # de la misma marca (copy distinto, mismo brandboard).
+    content = [
+        {"type": "text", "text": PROMPT_EXTRACT_ALL},
+        {"type": "text", "text": "=== BRANDBOARD ==="},
+        *_image_blocks(brandboard_images),
+        {
+            "type": "text",
+            "text": "=== COPY ===",
+            "cache_control": CACHE_CONTROL
+        },
+        *_image_blocks(copy_images)
+    ]
+
+    response_text, usage, finish_reason = _stream_completion(
+        model=VISION_MODEL,
+        messages=[{"role": "user", "content": content}],
+        max_tokens=EXTRACT_ALL_MAX_TOKENS,
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "extract_all", "strict": True, "schema": EXTRACT_ALL_SCHEMA}
+        },
+        extra_headers=PROMPT_CACHING_HEADERS
+    )
+
+    extracted = None
+    if finish_reason != "length":
+        try:
+            extracted = _parse_json(response_text)
+        except json.JSONDecodeError:
+            pass
+
+    # Respuesta cortada o incompleta (p. ej. un proveedor que ignora
+    # `response_format`): si al menos llegaron la marca y el copy crudo, las
+    # secciones se generan aparte con STRUCTURING_MODEL
+    if not _is_complete_extraction(extracted):
+        brand_info = _json_field(response_text, "brand_info")
+        raw_copy = _json_field(response_text, "raw_copy")
+        if not isinstance(brand_info, dict) or not isinstance(raw_copy, str):
+            if finish_reason == "length":
+                raise ValueError(
+                    "La respuesta del modelo se cortó por superar el límite de "
+                    f"{EXTRACT_ALL_MAX_TOKENS} tokens. Prueba con menos capturas de copy."
+                )
+            raise ValueError(
+                "La respuesta del modelo no tiene el formato esperado "
+                "(brand_info, raw_copy, sections_markdown)"
+            )
+        sections, sections_usage = structure_copy_into_sections(raw_copy)
+        extracted = {"brand_info": brand_info, "raw_copy": raw_copy, "sections_markdown": sections}
+        usage = {"extract_all": usage, "secciones": sections_usage}
+
+    if len(store) >= EXTRACTION_STORE_SIZE:
+        store.pop(next(iter(store)))
+    store[digest] = extracted
+    return extracted, usage
+
+
+def structure_copy_into_sections(raw_copy):
+    """Organiza el copy extraído en secciones numeradas para Lovable.
+
+    Paso de solo texto, usado como respaldo cuando extract_all no devuelve
+    las secciones. Devuelve (secciones, uso de tokens).
+    """
+    instrucciones = (
+        "Organiza el copy de landing page que aparece en <copy> en secciones "
+        "numeradas para Lovable.\n\n" + PROMPT_SECCIONES
+    )
+
+    sections, usage, finish_reason = _stream_completion(
+        model=STRUCTURING_MODEL,
+        messages=[{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": instrucciones},
+                {"type": "text", "text": f"<copy>\n{raw_copy}\n</copy>"}
+            ]
         }],
-        max_tokens=4000
+        max_tokens=STRUCTURING_MAX_TOKENS
     )
+    if finish_reason == "length":
+        raise ValueError(
+            "Las secciones se cortaron por superar el límite de "
+            f"{STRUCTURING_MAX_TOKENS} tokens."
+        )
 
-    return response.choices[0].message.content.strip()
+    return sections, usage
 
 
 def generate_lovable_prompt(brand_info, structured_sections):
     """Genera el prompt final para Lovable."""
 
-    return PLANTILLA_LOVABLE.format(
-        color_primario=brand_info.get("color_primario", "#000000"),
-        color_secundario=brand_info.get("color_secundario", "#666666"),
-        color_texto=brand_info.get("color_texto", "gris oscuro"),
-        color_fondo=brand_info.get("color_fondo", "blanco"),
-        tipografia=brand_info.get("tipografia", "Inter"),
-        estilo=brand_info.get("estilo", "moderno, limpio, profesional"),
-        secciones=structured_sections
+    return PLANTILLA_LOVABLE.format_map(
+        ChainMap({"secciones": structured_sections}, brand_info, BRAND_DEFAULTS)
     )
 
 
@@ -316,8 +569,11 @@ with col1:
         accept_multiple_files=True,
         key="brandboard"
     )
-    if brandboard_files:
-        st.success(f"✅ {len(brandboard_files)} imagen(es) subida(s)")
+    brandboard_images = _payloads(brandboard_files or [])
+    brandboard_digests = file_digests(brandboard_files or [], brandboard_images, "brandboard_digests")
+    if brandboard_images:
+        brandboard_images, brandboard_digests = dedupe_images(brandboard_images, brandboard_digests)
+        st.success(f"✅ {len(brandboard_images)} imagen(es) subida(s)")
 
 with col2:
     st.subheader("📝 Copy de la Landing")
@@ -328,85 +584,91 @@ with col2:
         accept_multiple_files=True,
         key="copy"
     )
-    if copy_files:
-        st.success(f"✅ {len(copy_files)} imagen(es) subida(s)")
+    copy_images = _payloads(copy_files or [])
+    copy_digests = file_digests(copy_files or [], copy_images, "copy_digests")
+    if copy_images:
+        copy_images, copy_digests = dedupe_images(copy_images, copy_digests)
+        st.success(f"✅ {len(copy_images)} imagen(es) subida(s)")
 
 st.divider()
 
-# Botón para generar
-if st.button("🚀 Generar Prompt para Lovable", type="primary", use_container_width=True):
+# Si cambian las imágenes subidas, el resultado anterior ya no corresponde
+uploads = (tuple(brandboard_digests), tuple(copy_digests))
+if st.session_state.get("result_uploads") not in (None, uploads):
+    for key in ("final_prompt", "brand_info", "raw_copy", "usage", "result_uploads"):
+        st.session_state.pop(key, None)
 
-    if not brandboard_files:
-        st.error("⚠️ Sube al menos una imagen del brandboard")
-    elif not copy_files:
-        st.error("⚠️ Sube al menos una imagen del copy")
-    else:
-        with st.spinner("Procesando imágenes con Claude Vision..."):
 
-            # Paso 1: Extraer info del brandboard
-            st.info("🔍 Analizando brandboard...")
-            try:
-                brand_info = extract_brand_info(brandboard_files)
+@st.fragment
+def _render_result():
+    """Muestra el resultado guardado en session_state.
 
-                # Mostrar info extraída
-                with st.expander("📊 Información de marca extraída", expanded=True):
-                    st.json(brand_info)
+    Como fragment, interactuar con sus widgets (expanders, descarga) solo
+    reejecuta esta función y no todo el script.
+    """
+    final_prompt = st.session_state["final_prompt"]
 
-            except Exception as e:
-                st.error(f"Error al analizar brandboard: {str(e)}")
-                st.stop()
+    # Mostrar info extraída
+    with st.expander("📊 Información de marca extraída", expanded=True):
+        st.json(st.session_state["brand_info"])
 
-            # Paso 2: Extraer copy
-            st.info("📝 Transcribiendo copy...")
-            try:
-                raw_copy = extract_copy(copy_files)
+    with st.expander("📄 Copy extraído (texto crudo)", expanded=False):
+        st.text(st.session_state["raw_copy"])
 
-                with st.expander("📄 Copy extraído (texto crudo)", expanded=False):
-                    st.text(raw_copy)
+    with st.expander("📈 Uso de tokens (prompt caching)", expanded=False):
+        st.json(st.session_state["usage"])
 
-            except Exception as e:
-                st.error(f"Error al extraer copy: {str(e)}")
-                st.stop()
+    st.success("✅ ¡Prompt generado!")
+
+    st.subheader("📋 Prompt para Lovable")
+    st.caption("Copia este prompt y pégalo en Lovable junto con las imágenes del brandboard")
+    st.code(final_prompt, language="markdown", wrap_lines=True)
+
+    st.download_button(
+        label="📥 Descargar prompt como archivo",
+        data=final_prompt,
+        file_name="prompt_lovable.txt",
+        mime="text/plain"
+    )
 
-            # Paso 3: Estructurar en secciones
-            st.info("🏗️ Estructurando secciones...")
+
+# Botón para generar
+regenerate_clicked = st.button("🚀 Generar Prompt para Lovable", type="primary", use_container_width=True)
+
+if regenerate_clicked:
+
+    if not brandboard_images:
+        st.error("⚠️ Sube al menos una imagen del brandboard")
+    elif not copy_images:
+        st.error("⚠️ Sube al menos una imagen del copy")
+    else:
+        with st.spinner("Procesando imágenes con Claude Vision..."):
+
+            # Paso 1: Extraer marca y secciones en una sola llamada
+            st.info("🔍 Analizando brandboard y estructurando el copy...")
             try:
-                structured_sections = structure_copy_into_sections(raw_copy)
+                extracted, usage = extract_all(brandboard_images, copy_images)
+                brand_info = extracted["brand_info"]
+                raw_copy = extracted["raw_copy"]
+                structured_sections = extracted["sections_markdown"]
             except Exception as e:
-                st.error(f"Error al estructurar secciones: {str(e)}")
+                st.error(f"Error al procesar las imágenes: {str(e)}")
                 st.stop()
 
-            # Paso 4: Generar prompt final
+            # Paso 2: Generar prompt final
             st.info("✨ Generando prompt final...")
             final_prompt = generate_lovable_prompt(brand_info, structured_sections)
 
-        # Mostrar resultado
-        st.success("✅ ¡Prompt generado!")
+        # Guardar el resultado para que sobreviva a los reruns
+        st.session_state["final_prompt"] = final_prompt
+        st.session_state["brand_info"] = brand_info
+        st.session_state["raw_copy"] = raw_copy
+        st.session_state["usage"] = usage
+        st.session_state["result_uploads"] = uploads
 
-        st.subheader("📋 Prompt para Lovable")
-        st.text_area(
-            "Copia este prompt y pégalo en Lovable junto con las imágenes del brandboard",
-            value=final_prompt,
-            height=500,
-            key="result"
-        )
-
-        # Botón para copiar (usando JavaScript)
-        st.markdown("""
-        <script>
-        function copyToClipboard() {
-            const text = document.querySelector('textarea').value;
-            navigator.clipboard.writeText(text);
-        }
-        </script>
-        """, unsafe_allow_html=True)
-
-        st.download_button(
-            label="📥 Descargar prompt como archivo",
-            data=final_prompt,
-            file_name="prompt_lovable.txt",
-            mime="text/plain"
-        )
+# Mostrar resultado
+if st.session_state.get("final_prompt") is not None:
+    _render_result()
 
 # Footer
 st.divider()